@@ -1,29 +1,44 @@
 #!/usr/bin/env python3.7
 """Realme Updates Tracker archive yaml generator"""
+from collections import defaultdict
 from glob import glob
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+
+
+def codename_from_link(link: str) -> str:
+    """Returns the device codename of a ROM download link"""
+    rom = link.rpartition('/')[2]
+    if 'sign' in link:
+        rom = rom.partition('_')[2]
+    return rom.partition('_')[0]
+
 
 def main():
     """RealmeUpdatesTracker archiver"""
     with open("links.txt", 'r') as links_list:
         all_links = links_list.readlines()
     links = {line.split(' ')[0]: line.split(' ')[1].strip() for line in all_links}
-    codenames = sorted(list(set(link.split('/')[-1].split('_')[0] for link in all_links)))
-    for codename in codenames:
-        roms = {version: link for version, link in links.items() if codename == link.split('/')[-1].split('_')[0]}
+    roms_by_codename = defaultdict(dict)
+    for version, link in links.items():
+        roms_by_codename[codename_from_link(link)][version] = link
+    for codename, roms in sorted(roms_by_codename.items()):
         with open(f'{codename}.yml', 'w') as output:
-            yaml.dump({codename: roms}, output)
+            yaml.dump({codename: roms}, output, Dumper=Dumper)
 
     yaml_files = [x for x in sorted(glob(f'*.yml'))
                   if not x.endswith('archive.yml')]
     yaml_data = []
     for file in yaml_files:
         with open(file, "r") as yaml_file:
-            yaml_data.append(yaml.load(yaml_file, Loader=yaml.FullLoader))
+            yaml_data.append(yaml.load(yaml_file, Loader=Loader))
     with open('archive.yml', "w") as output:
-        yaml.dump(yaml_data, output, allow_unicode=True)
+        yaml.dump(yaml_data, output, Dumper=Dumper, allow_unicode=True)
 
 
 if __name__ == '__main__':
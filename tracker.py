@@ -1,24 +1,74 @@
 #!/usr/bin/env python3
 """Realme Updates Tracker"""
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from glob import glob
-from os import environ, system, rename, path
+from os import environ, rename, path, scandir
+from subprocess import run
 
 import yaml
-from bs4 import BeautifulSoup
-from requests import get, post
+from lxml import html as lxhtml
+from lxml.etree import XPath
+from requests import Session
+from requests.adapters import HTTPAdapter, Retry
+
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
 
 # Setup variables
 BOT_TOKEN = environ["realme_tg_bot_token"]
 CHAT = "@RealmeUpdatesTracker"
+TELEGRAM_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
 GIT_OAUTH_TOKEN = environ['GIT_TOKEN']
 
 SITE = "https://realmeupdater.com"
 R_SITE = "https://realme.com"
 PAGE = "support/software-update"
 
-DEVICES = {}
+# Maximum parallel connections to realme website
+WORKERS = 8
+SESSION = Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=WORKERS, pool_maxsize=WORKERS))
+# Keep the connection to telegram alive between messages
+TG_SESSION = Session()
+TG_SESSION.mount("https://", HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3)))
+
+# codename: device names, kept as dict keys to preserve their first-seen order
+DEVICES = defaultdict(dict)
+
+VERSION_RE = re.compile(r'([A-Z0-9+]+_[0-9]+[._][A-Z]+[._]?[0-9]+)')
+# Changelog lines that aren't bullet points are section titles
+CHANGELOG_TITLE_RE = re.compile(r'^(?![●*])(.+)$', re.M)
+
+# Precompiled XPath queries of the downloads page
+HAS_CLASS = "contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+ITEMS_LIST_XPATH = XPath(f"(//div[{HAS_CLASS.format('software-items')}])[1]")
+ITEMS_XPATH = XPath(f".//div[{HAS_CLASS.format('software-item')}]")
+TITLE_XPATH = XPath(f"string(.//h3[{HAS_CLASS.format('software-mobile-title')}])")
+SYSTEM_XPATH = XPath(f"string(.//div[{HAS_CLASS.format('software-system')}])")
+FIELDS_XPATH = XPath(f".//div[{HAS_CLASS.format('software-field')}]")
+SPAN_XPATH = XPath("string(.//span)")
+DOWNLOAD_XPATH = XPath(f"string(.//div[{HAS_CLASS.format('software-download')}]"
+                       f"//a[{HAS_CLASS.format('software-button')}]/@data-href)",
+                       smart_strings=False)
+CHANGELOG_XPATH = XPath(f"(.//div[{HAS_CLASS.format('software-log')}])[1]//text()",
+                        smart_strings=False)
+
+
+def str_presenter(dumper, data):
+    """
+    Represent multi-line strings as yaml literal blocks
+    """
+    # https://stackoverflow.com/a/33300001
+    if len(data.splitlines()) > 1:
+        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+
+
+yaml.add_representer(str, str_presenter, Dumper=Dumper)
 
 
 def update_device(codename: str, device: str):
@@ -27,11 +77,7 @@ def update_device(codename: str, device: str):
     :param codename: device codename
     :param device: device name
     """
-    try:
-        if DEVICES[codename] and device not in DEVICES[codename].split('/'):
-            DEVICES.update({codename: f"{DEVICES[codename]}/{device}"})
-    except KeyError:
-        DEVICES.update({codename: device})
+    DEVICES[codename][device] = None
 
 
 def get_downloads_html(url: str) -> list:
@@ -40,8 +86,14 @@ def get_downloads_html(url: str) -> list:
     :param url: realme downloads page
     :return: list of devices latest downloads HTML
     """
-    downloads_html = BeautifulSoup(get(url).text, "html.parser") \
-        .select_one("div.software-items").select("div.software-item")
+    response = SESSION.get(url, timeout=30)
+    response.raise_for_status()
+    # Don't let lxml guess the encoding, pages without a meta charset are decoded as Latin-1
+    response.encoding = 'utf-8'
+    items_list = ITEMS_LIST_XPATH(lxhtml.fromstring(response.text))
+    if not items_list:
+        raise ValueError(f"Can't find the downloads list in {url}")
+    downloads_html = ITEMS_XPATH(items_list[0])
     return downloads_html
 
 
@@ -54,6 +106,18 @@ def clean_text(text: str) -> str:
     return text.strip().replace('  ', ' ')
 
 
+def codename_from_link(link: str) -> str:
+    """
+    Returns the device codename of a ROM download link
+    :param link: ROM download link
+    :return: device codename
+    """
+    rom = link.rpartition('/')[2]
+    if 'sign' in link:
+        rom = rom.partition('_')[2]
+    return rom.partition('_')[0]
+
+
 def parse_html(html: list, region: str) -> list:
     """
     Parse each device HTML into a list of dictionaries
@@ -63,44 +127,42 @@ def parse_html(html: list, region: str) -> list:
     """
     updates = []
     for item in html:
-        title_tag = item.select_one("h3.software-mobile-title")
-        title = clean_text(title_tag.text)
+        title = clean_text(TITLE_XPATH(item))
         if "真我" in title:
             title = title.replace("真我", "realme ")
-        _system = clean_text(item.select_one("div.software-system").text)
+        _system = clean_text(SYSTEM_XPATH(item))
         if not _system:
             continue
+        fields = FIELDS_XPATH(item)
         try:
-            version = re.search(r'([A-Z0-9+]+_[0-9]+(?:.|_)[A-Z]+(?:.|_)[0-9]+)',
-                                item.select("div.software-field")[0].text).group(1)
-            codename = version.split('_')[0]
+            version = VERSION_RE.search(fields[0].text_content()).group(1)
+            codename = version.partition('_')[0]
         except (IndexError, AttributeError):
             version = "Unknown"
             codename = "Unknown"
         try:
-            date = item.select("div.software-field")[1].text.strip().split(": ")[1].strip()
-            if len(date.split('/')[0]) == 4:
-                date = datetime.strptime(date, "%Y/%m/%d").strftime("%d/%m/%Y")
+            date = fields[1].text_content().strip().split(": ")[1].strip()
+            if len(date) == 10 and date[4] == '/' and date[7] == '/':
+                date = f"{date[8:10]}/{date[5:7]}/{date[:4]}"
+            elif len(date.split('/')[0]) == 4:
+                try:
+                    date = datetime.strptime(date, "%Y/%m/%d").strftime("%d/%m/%Y")
+                except ValueError:
+                    pass
         except IndexError:
             date = "Unknown"
-        size = clean_text(item.select("div.software-field")[2].span.text)
+        size = clean_text(SPAN_XPATH(fields[2]))
         if size.endswith('G'):
             size = size.replace('G', 'GB')
         try:
-            md5 = item.select("div.software-field")[3].text.strip().split(": ")[1].strip()
+            md5 = fields[3].text_content().strip().split(": ")[1].strip()
         except IndexError:
             md5 = "Unknown"
-        download = item.select_one("div.software-download").select_one(
-            "a.software-button")["data-href"]
+        download = DOWNLOAD_XPATH(item)
         if download == "https://download.c.realme.com/osupdate/":
             continue
-        changelog = item.select_one("div.software-log").get_text("\n", strip=True)
-        changelog_text = ""
-        for line in changelog.splitlines():
-            if line.startswith('●') or line.startswith('*'):
-                changelog_text += f"{line}\n"
-            else:
-                changelog_text += f"**{line}**:\n"
+        changelog = "\n".join(line.strip() for line in CHANGELOG_XPATH(item) if line.strip())
+        changelog_text = CHANGELOG_TITLE_RE.sub(r'**\1**:', changelog) + "\n" if changelog else ""
         update = {
             "device": title,
             "codename": codename,
@@ -113,8 +175,6 @@ def parse_html(html: list, region: str) -> list:
             "download": download,
             "changelog": changelog_text
         }
-        if download:
-            write_yaml(update, f"data/{region}/{codename}.yml")
         updates.append(update)
         update_device(codename, title)
     return updates
@@ -127,17 +187,18 @@ def write_yaml(downloads, filename: str):
     :param filename: output file name
     :return:
     """
+    with open(f"{filename}", 'w') as out:
+        yaml.dump(downloads, out, Dumper=Dumper, allow_unicode=True)
 
-    def str_presenter(dumper, data):
-        # https://stackoverflow.com/a/33300001
-        if len(data.splitlines()) > 1:
-            return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
-        return dumper.represent_scalar('tag:yaml.org,2002:str', data)
-
-    yaml.add_representer(str, str_presenter)
 
-    with open(f"{filename}", 'w') as out:
-        yaml.dump(downloads, out, allow_unicode=True)
+def load_yaml(filename: str):
+    """
+    Load a yaml file
+    :param filename: yaml file name
+    :return: file data
+    """
+    with open(filename, "rb") as yaml_file:
+        return yaml.load(yaml_file, Loader=Loader)
 
 
 def merge_yaml(regions: dict):
@@ -147,26 +208,21 @@ def merge_yaml(regions: dict):
     yaml_files = [value for key, value in regions.items()]
     yaml_data = []
     for file in yaml_files:
-        with open(f"data/{file}/{file}.yml", "r") as yaml_file:
-            updates = yaml.load(yaml_file, Loader=yaml.FullLoader)
-            for update in updates:
-                yaml_data.append(update)
+        yaml_data.extend(load_yaml(f"data/{file}/{file}.yml"))
     with open('data/latest.yml', "w") as output:
-        yaml.dump(yaml_data, output, allow_unicode=True)
+        yaml.dump(yaml_data, output, Dumper=Dumper, allow_unicode=True)
 
 
 def merge_archive():
     """
     merge all archive yaml files into one file
     """
-    yaml_files = [x for x in sorted(glob('data/archive/*.yml'))
-                  if not x.endswith('archive.yml')]
-    yaml_data = []
-    for file in yaml_files:
-        with open(file, "r") as yaml_file:
-            yaml_data.append(yaml.load(yaml_file, Loader=yaml.FullLoader))
+    yaml_files = sorted(entry.path for entry in scandir('data/archive')
+                        if entry.name.endswith('.yml') and not entry.name.startswith('.')
+                        and entry.name != 'archive.yml')
+    yaml_data = [load_yaml(file) for file in yaml_files]
     with open('data/archive/archive.yml', "w") as output:
-        yaml.dump(yaml_data, output, allow_unicode=True)
+        yaml.dump(yaml_data, output, Dumper=Dumper, allow_unicode=True)
 
 
 def diff_yaml(filename: str) -> list:
@@ -178,8 +234,8 @@ def diff_yaml(filename: str) -> list:
     try:
         with open(f'data/{filename}/{filename}.yml', 'r') as new, \
                 open(f'data/{filename}/old_{filename}', 'r') as old_data:
-            latest = yaml.load(new, Loader=yaml.FullLoader)
-            old = yaml.load(old_data, Loader=yaml.FullLoader)
+            latest = yaml.load(new, Loader=Loader)
+            old = yaml.load(old_data, Loader=Loader)
             first_run = False
     except FileNotFoundError:
         print(f"Can't find old {filename} files, skipping")
@@ -188,12 +244,10 @@ def diff_yaml(filename: str) -> list:
         if len(latest) == len(old):
             return [new_ for new_, old_ in zip(latest, old)
                     if not new_['version'] == old_['version']]
-        old_codenames = [i["codename"] for i in old]
-        new_codenames = [i["codename"] for i in latest]
-        changes = [i for i in new_codenames if i not in old_codenames]
+        old_codenames = {i["codename"] for i in old}
+        changes = {i["codename"] for i in latest} - old_codenames
         if changes:
-            return [i for i in latest for codename in changes
-                    if codename == i["codename"]]
+            return [i for i in latest if i["codename"] in changes]
 
 
 def generate_message(update: dict) -> str:
@@ -239,8 +293,7 @@ def tg_post(message: str) -> int:
         ('parse_mode', "Markdown"),
         ('disable_web_page_preview', "yes")
     )
-    telegram_url = "https://api.telegram.org/bot" + BOT_TOKEN + "/sendMessage"
-    telegram_req = post(telegram_url, params=params)
+    telegram_req = TG_SESSION.post(TELEGRAM_URL, data=params, timeout=10)
     telegram_status = telegram_req.status_code
     if telegram_status == 200:
         pass
@@ -254,23 +307,23 @@ def tg_post(message: str) -> int:
     return telegram_status
 
 
-def archive(update: dict):
-    """Append new update to the archive"""
-    link = update['download']
-    version = update['version']
-    codename = link.split('/')[-1].split('_')[0] \
-        if 'sign' not in link else link.split('/')[-1].split('_')[1]
-    try:
-        with open(f'data/archive/{codename}.yml', 'r') as yaml_file:
-            data = yaml.load(yaml_file, Loader=yaml.FullLoader)
-            data[codename].update({version: link})
-            data.update({codename: data[codename]})
-            with open(f'data/archive/{codename}.yml', 'w') as output:
-                yaml.dump(data, output, allow_unicode=True)
-    except FileNotFoundError:
-        data = {codename: {version: link}}
+def archive(updates: list):
+    """
+    Append new updates to the archive, touching each codename file once
+    :param updates: list of dictionaries of new updates
+    """
+    roms_by_codename = defaultdict(dict)
+    for update in updates:
+        link = update['download']
+        roms_by_codename[codename_from_link(link)][update['version']] = link
+    for codename, roms in roms_by_codename.items():
+        try:
+            data = load_yaml(f'data/archive/{codename}.yml')
+            data[codename].update(roms)
+        except FileNotFoundError:
+            data = {codename: roms}
         with open(f'data/archive/{codename}.yml', 'w') as output:
-            yaml.dump(data, output, allow_unicode=True)
+            yaml.dump(data, output, Dumper=Dumper, allow_unicode=True)
 
 
 def git_commit_push():
@@ -278,12 +331,17 @@ def git_commit_push():
     git add - git commit - git push
     """
     today = str(datetime.today()).split('.')[0]
-    system("git add *.yml */*.yml && git -c \"user.name=RealmeCI\" -c "
-           "\"user.email=RealmeCI@example.com\" "
-           "commit -m \"sync: {}\" && "" \
-           ""git push -q https://{}@github.com/RealmeUpdater/"
-           "realme-updates-tracker.git HEAD:master"
-           .format(today, GIT_OAUTH_TOKEN))
+    if run(["git", "add", "--", "*.yml"]).returncode != 0:
+        return
+    if run(["git", "diff", "--quiet", "--cached"]).returncode == 0:
+        print("Nothing to commit.")
+        return
+    if run(["git", "-c", "user.name=RealmeCI", "-c", "user.email=RealmeCI@example.com",
+            "commit", "-m", f"sync: {today}"]).returncode != 0:
+        return
+    run(["git", "push", "-q",
+         f"https://{GIT_OAUTH_TOKEN}@github.com/RealmeUpdater/realme-updates-tracker.git",
+         "HEAD:master"])
 
 
 def main():
@@ -291,15 +349,31 @@ def main():
     Realme updates scraper and tracker
     """
     with open("data/regions.yml", "r") as yaml_file:
-        regions = yaml.load(yaml_file, Loader=yaml.FullLoader)
-    for region_code, region in regions.items():
+        regions = yaml.load(yaml_file, Loader=Loader)
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        downloads = executor.map(get_downloads_html,
+                                 [f"{R_SITE}/{region_code}/{PAGE}" for region_code in regions])
+    updated_regions = []
+    for region, downloads_html in zip(regions.values(), downloads):
+        updates = parse_html(downloads_html, region)
         if path.exists(f'data/{region}/{region}.yml'):
+            old_updates = load_yaml(f'data/{region}/{region}.yml')
+            if old_updates == updates:
+                print(f"{region}: No new updates.")
+                continue
+            if old_updates and not updates:
+                print(f"{region}: No updates found, keeping the old ones.")
+                continue
             rename(f'data/{region}/{region}.yml', f'data/{region}/old_{region}')
-        downloads_html = get_downloads_html(f"{R_SITE}/{region_code}/{PAGE}")
-        updates = parse_html(downloads_html, region)
+        for update in updates:
+            if update["download"]:
+                write_yaml(update, f"data/{region}/{update['codename']}.yml")
         write_yaml(updates, f"data/{region}/{region}.yml")
-    merge_yaml(regions)
-    for region in list(regions.values()):
+        updated_regions.append(region)
+    if updated_regions:
+        merge_yaml(regions)
+    new_updates = []
+    for region in updated_regions:
         changes = diff_yaml(region)
         if changes:
             for update in changes:
@@ -310,11 +384,14 @@ def main():
                 status = tg_post(message)
                 if status == 200:
                     print(f"{update['device']}: Telegram Message sent successfully")
-                archive(update)
+                new_updates.append(update)
         else:
             print(f"{region}: No new updates.")
-    merge_archive()
-    write_yaml(DEVICES, "data/devices.yml")
+    if new_updates:
+        archive(new_updates)
+        merge_archive()
+    write_yaml({codename: '/'.join(devices) for codename, devices in DEVICES.items()},
+               "data/devices.yml")
     git_commit_push()
 
 